@@ -17,42 +17,101 @@ import time
 import re
 import shutil
 import atexit
+import select
+import tempfile
 # python3-psutil
 import psutil
+# python3-inotify-simple (optional, used to avoid polling the file system)
+try:
+    from inotify_simple import INotify, flags
+    has_inotify = True
+except ImportError:  # pragma: no cover
+    has_inotify = False
 
 from kiauto.misc import (WRONG_ARGUMENTS, KICAD_VERSION_5_99)
 from kiauto import log
 logger = log.get_logger(__name__)
 
 
+def _watch_dir(dir):
+    """ Get notified when a file is closed or moved into dir.
+        None if inotify isn't available """
+    if not has_inotify:  # pragma: no cover
+        return None
+    inotify = INotify()
+    try:
+        inotify.add_watch(dir, flags.CLOSE_WRITE | flags.MOVED_TO)
+    except OSError:  # pragma: no cover
+        # I.e. too many watches
+        inotify.close()
+        return None
+    return inotify
+
+
+def open_pidfd(pid):
+    """ File descriptor that becomes readable when the process finishes.
+        None if not supported (Python < 3.9 or Linux < 5.3) """
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):  # pragma: no cover
+        return None
+
+
 def wait_for_file_created_by_process(pid, file, timeout=15):
     process = psutil.Process(pid)
 
     DELAY = 0.2
     logger.debug('Waiting for file %s (pid %d)', file, pid)
-    for i in range(int(timeout/DELAY)):
-        kicad_died = False
-        try:
-            open_files = process.open_files()
-        except psutil.AccessDenied:
-            # Is our child, this access denied is because we are listing
-            # files for other process that took the pid of the old KiCad.
-            kicad_died = True
-        if kicad_died:
-            raise RuntimeError('KiCad unexpectedly died')
-        logger.debug(open_files)
-        if os.path.isfile(file):
-            file_open = False
-            for open_file in open_files:
-                if open_file.path == file:
-                    file_open = True
-            if file_open:
-                logger.debug('Waiting for process to close file')
+    # When possible we sleep until the file is closed or KiCad dies, otherwise we just poll
+    inotify = _watch_dir(os.path.dirname(file))
+    pidfd = open_pidfd(pid)
+    poll = select.poll()
+    if inotify:
+        poll.register(inotify.fileno(), select.POLLIN)
+        # Just in case we miss something
+        delay = DELAY*5
+    else:  # pragma: no cover
+        delay = DELAY
+    if pidfd is not None:
+        poll.register(pidfd, select.POLLIN)
+    end = time.monotonic()+timeout
+    try:
+        while True:
+            try:
+                open_files = process.open_files()
+            except psutil.AccessDenied:
+                # Is our child, this access denied is because we are listing
+                # files for other process that took the pid of the old KiCad.
+                raise RuntimeError('KiCad unexpectedly died')
+            logger.debug(open_files)
+            if os.path.isfile(file):
+                file_open = False
+                for open_file in open_files:
+                    if open_file.path == file:
+                        file_open = True
+                if file_open:
+                    logger.debug('Waiting for process to close file')
+                else:
+                    return
             else:
-                return
-        else:
-            logger.debug('Waiting for process to create file')
-        time.sleep(DELAY)
+                logger.debug('Waiting for process to create file')
+            remaining = end-time.monotonic()
+            if remaining <= 0:
+                break
+            for fd, _ in poll.poll(int(min(delay, remaining)*1000)):
+                if fd == pidfd:
+                    # Don't ask a dead process for its files, just check if the file is there
+                    if os.path.isfile(file):
+                        return
+                    raise RuntimeError('KiCad unexpectedly died')
+            if inotify:
+                # Discard the events, we check the file anyways
+                inotify.read(timeout=0)
+    finally:
+        if inotify:
+            inotify.close()
+        if pidfd is not None:
+            os.close(pidfd)
 
     raise RuntimeError('Timed out waiting for creation of %s' % file)
 
@@ -159,6 +218,7 @@ def restore_config(cfg):
     cfg.conf_kicad_bkp = restore_one_config('KiCad common', cfg.conf_kicad, cfg.conf_kicad_bkp)
     cfg.conf_hotkeys_bkp = restore_one_config('user hotkeys', cfg.conf_hotkeys, cfg.conf_hotkeys_bkp)
     cfg.conf_pcbnew_bkp = restore_one_config('pcbnew', cfg.conf_pcbnew, cfg.conf_pcbnew_bkp)
+    cfg.conf_pcbnew_tmp = remove_config_link(cfg.conf_pcbnew, cfg.conf_pcbnew_tmp)
 
 
 def backup_config(name, file, err, cfg):
@@ -178,6 +238,33 @@ def backup_config(name, file, err, cfg):
     return None
 
 
+def create_config_link(fname, content):
+    """ Write the content to a temporal file and atomically replace fname by a symlink to it.
+        The user config was already moved by backup_config, so we never touch it.
+        Returns the name of the temporal file """
+    with tempfile.NamedTemporaryFile(mode='wt', prefix='kiauto_'+os.path.basename(fname)+'_', delete=False) as f:
+        f.write(content)
+    link = fname+'.new'
+    if os.path.lexists(link):  # pragma: no cover
+        os.remove(link)
+    os.symlink(f.name, link)
+    os.rename(link, fname)
+    logger.debug('Using {} as {}'.format(f.name, fname))
+    return f.name
+
+
+def remove_config_link(fname, ftmp):
+    """ Remove the temporal file created by create_config_link, and the link if still there """
+    if ftmp is None:
+        return None
+    if os.path.islink(fname) and os.readlink(fname) == ftmp:
+        # We didn't restore a back-up, don't leave a dangling link
+        os.remove(fname)
+    if os.path.isfile(ftmp):
+        os.remove(ftmp)
+    return None
+
+
 def create_user_hotkeys(cfg):
     logger.debug('Creating a user hotkeys config')
     with open(cfg.conf_hotkeys, "wt") as text_file:
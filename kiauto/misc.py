@@ -115,6 +115,7 @@ class Config(object):
         # - pcbnew config
         self.conf_pcbnew = os.path.join(self.kicad_conf_path, 'pcbnew')
         self.conf_pcbnew_bkp = None
+        self.conf_pcbnew_tmp = None
         # - kicad config
         self.conf_kicad = os.path.join(self.kicad_conf_path, 'kicad_common')
         self.conf_kicad_bkp = None
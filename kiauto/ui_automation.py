@@ -16,21 +16,62 @@ and efficiently copy-pasting strings in the UI.
 Based on splitflap/electronics/scripts/export_util.py by Scott Bezek
 """
 import os
+import re
 from subprocess import (Popen, CalledProcessError, TimeoutExpired, call, check_output, STDOUT, DEVNULL, PIPE)
-import tempfile
 import time
 import shutil
 import signal
+import select
+import ctypes
+import ctypes.util
 from contextlib import contextmanager
 # python3-xvfbwrapper
 from xvfbwrapper import Xvfb
-
+# python3-xlib (optional, used to wait for X events instead of polling)
+try:
+    from Xlib import X
+    from Xlib.display import Display
+    from Xlib.error import DisplayError, XError, CatchError
+    has_xlib = True
+except ImportError:  # pragma: no cover
+    has_xlib = False
+
+from kiauto.file_util import open_pidfd
 from kiauto import log
 logger = log.get_logger(__name__)
+# Connection to the virtual X server, only available when python3-xlib is installed
+x_display = None
+# Session used to send keys, only available when libxdo can be loaded
+xdo_session = None
+# Tools we use when available, they won't appear during the run
+_SETXKBMAP = shutil.which('setxkbmap')
+_XSET = shutil.which('xset')
+_WMCTRL = shutil.which('wmctrl')
+_XPROP = shutil.which('xprop')
+_X11VNC = shutil.which('x11vnc')
 
 
 class PopenContext(Popen):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Used to wait for the process without polling (Python 3.9 and Linux 5.3)
+        self.pidfd = open_pidfd(self.pid)
+
+    def wait_end(self, timeout):
+        """ Wait for the process to finish, returns False on time-out """
+        if self.pidfd is None:  # pragma: no cover
+            try:
+                self.wait(timeout)
+            except TimeoutExpired:
+                return False
+            return True
+        if not _wait_event(self.pidfd, timeout):
+            return False  # pragma: no cover
+        # Already finished, just collect it
+        self.wait()
+        return True
+
     def __exit__(self, type, value, traceback):
         logger.debug("Closing pipe with %d", self.pid)
         # Note: currently we don't communicate with the child so these cases are never used.
@@ -51,20 +92,18 @@ class PopenContext(Popen):
             os.killpg(os.getpgid(self.pid), signal.SIGTERM)
             # self.terminate()
         # Wait for the process to terminate, to avoid zombies.
-        try:
-            # Wait for 3 seconds
-            self.wait(3)
-            retry = False
-        except TimeoutExpired:  # pragma: no cover
-            # The process still alive after 3 seconds
-            retry = True
-            pass
+        # Wait for 3 seconds
+        retry = not self.wait_end(3)
         if retry:  # pragma: no cover
+            # The process still alive after 3 seconds
             logger.debug("Killing %d", self.pid)
             # We shouldn't get here. Kill the process and wait upto 10 seconds
             os.killpg(os.getpgid(self.pid), signal.SIGKILL)
             # self.kill()
             self.wait(10)
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
 
 
 def wait_xserver():
@@ -72,20 +111,28 @@ def wait_xserver():
     DELAY = 0.5
     logger.debug('Waiting for virtual X server ...')
     logger.debug('Current DISPLAY is '+os.environ['DISPLAY'])
-    if shutil.which('setxkbmap'):
-        cmd = ['setxkbmap', '-query']
-    elif shutil.which('setxkbmap'):  # pragma: no cover
-        cmd = ['xset', 'q']
+    if has_xlib:
+        # Just connecting to the server is enough, no need to run anything
+        XDELAY = 0.05
+        for i in range(int(timeout/XDELAY)):
+            try:
+                return Display()
+            except (DisplayError, OSError):
+                pass
+            time.sleep(XDELAY)
+        raise RuntimeError('Timed out waiting for virtual X server')
+    if _SETXKBMAP is not None:
+        cmd = [_SETXKBMAP, '-query']
+    elif _XSET is not None:  # pragma: no cover
+        cmd = [_XSET, 'q']
     else:  # pragma: no cover
         cmd = ['ls']
         logger.warning('No setxkbmap nor xset available, unable to verify if X is running')
     for i in range(int(timeout/DELAY)):
-        with open(os.devnull, 'w') as fnull:
-            logger.debug('Checking using '+str(cmd))
-            ret = call(cmd, stdout=fnull, stderr=STDOUT, close_fds=True)
-            # ret = call(['xset', 'q'])
+        logger.debug('Checking using '+str(cmd))
+        ret = call(cmd, stdout=DEVNULL, stderr=STDOUT, close_fds=True)
         if not ret:
-            return
+            return None
         logger.debug('   Retry')
         time.sleep(DELAY)
     raise RuntimeError('Timed out waiting for virtual X server')
@@ -95,22 +142,95 @@ def wait_wm():
     timeout = 10
     DELAY = 0.5
     logger.debug('Waiting for Window Manager ...')
-    if shutil.which('wmctrl'):
-        cmd = ['wmctrl', '-m']
+    if x_display is not None:
+        # A EWMH compliant WM (i.e. fluxbox) sets this property in the root window,
+        # this is what wmctrl checks. We get a PropertyNotify when it changes.
+        wm_check = x_display.intern_atom('_NET_SUPPORTING_WM_CHECK')
+        root = x_display.screen().root
+        logger.debug('Checking _NET_SUPPORTING_WM_CHECK')
+        for _ in _timed_loop(timeout, DELAY):
+            if root.get_full_property(wm_check, X.AnyPropertyType) is not None:
+                return
+            logger.debug('   Retry')
+        raise RuntimeError('Timed out waiting for WM server')
+    if _WMCTRL is not None:
+        cmd = [_WMCTRL, '-m']
     else:  # pragma: no cover
         logger.warning('No wmctrl, unable to verify if WM is running')
         time.sleep(2)
         return
     logger.debug('Checking using '+str(cmd))
-    for i in range(int(timeout/DELAY)):
+    for _ in _timed_loop(timeout, DELAY):
         ret = call(cmd, stdout=DEVNULL, stderr=STDOUT, close_fds=True)
         if not ret:
             return
         logger.debug('   Retry')
-        time.sleep(DELAY)
     raise RuntimeError('Timed out waiting for WM server')
 
 
+@contextmanager
+def x_connection():
+    """ Connect to the X server (once it's running) to get notified about windows changes """
+    global x_display
+    x_display = wait_xserver()
+    if x_display is None:  # pragma: no cover
+        logger.debug('No python3-xlib, using polling to wait for windows')
+        yield
+        return
+    # Windows mapped/unmapped, focus and WM changes
+    x_display.screen().root.change_attributes(event_mask=X.SubstructureNotifyMask | X.FocusChangeMask |
+                                              X.PropertyChangeMask)
+    x_display.flush()
+    try:
+        yield
+    finally:
+        x_display.close()
+        x_display = None
+
+
+def _wait_event(fd, timeout):
+    """ Wait until fd has data to read or timeout seconds elapsed """
+    poll = select.poll()
+    poll.register(fd, select.POLLIN)
+    return bool(poll.poll(int(timeout*1000)))
+
+
+def _wait_x_event(timeout):
+    """ Wait until the X server reports an event or timeout seconds elapsed.
+        Without an X connection this is just a sleep """
+    if x_display is None:  # pragma: no cover
+        time.sleep(timeout)
+        return
+    if not x_display.pending_events():
+        _wait_event(x_display.fileno(), timeout)
+    # We just use the events to wake-up, discard them
+    while x_display.pending_events():
+        x_display.next_event()
+
+
+def _select_x_events(id, mask):
+    """ Ask the X server to report the events in mask for the id window """
+    if x_display is None:  # pragma: no cover
+        return
+    window = x_display.create_resource_object('window', int(id))
+    # The window could be destroyed, ignore the errors
+    window.change_attributes(event_mask=mask, onerror=CatchError())
+    x_display.flush()
+
+
+def _timed_loop(timeout, delay):
+    """ Iterator used for the waiting loops.
+        Between iterations we wait for an X event or delay seconds, the
+        whole loop is limited to timeout seconds """
+    end = time.monotonic()+timeout
+    while True:
+        yield
+        remaining = end-time.monotonic()
+        if remaining <= 0:
+            return
+        _wait_x_event(min(delay, remaining))
+
+
 @contextmanager
 def start_wm(do_it):
     if do_it:
@@ -148,11 +268,11 @@ def start_record(do_record, video_dir, video_name):
 @contextmanager
 def start_x11vnc(do_it, old_display):
     if do_it:
-        if not shutil.which('x11vnc'):
+        if _X11VNC is None:
             logger.error("x11vnc isn't installed, please install it")
             yield
         else:
-            cmd = ['x11vnc', '-display', os.environ['DISPLAY'], '-localhost']
+            cmd = [_X11VNC, '-display', os.environ['DISPLAY'], '-localhost']
             logger.debug('Starting VNC server: '+str(cmd))
             with PopenContext(cmd, stdout=DEVNULL, stderr=DEVNULL, close_fds=True, start_new_session=True) as x11vnc_proc:
                 if old_display is None:
@@ -175,36 +295,126 @@ def recorded_xvfb(cfg):
         old_display = None
         pass
     with Xvfb(width=cfg.rec_width, height=cfg.rec_height, colordepth=cfg.colordepth):
-        wait_xserver()
-        with start_x11vnc(cfg.start_x11vnc, old_display):
-            with start_wm(cfg.use_wm):
-                with start_record(cfg.record, cfg.video_dir, cfg.video_name):
-                    yield
+        with x_connection():
+            with xdotool_session():
+                with start_x11vnc(cfg.start_x11vnc, old_display):
+                    with start_wm(cfg.use_wm):
+                        with start_record(cfg.record, cfg.video_dir, cfg.video_name):
+                            yield
+
+
+class XdotoolSession(object):
+    """ Sends keys using libxdo (the xdotool library).
+        The connection to the X server is kept for the whole session, so we
+        don't need to run xdotool (and connect to the X server) for each key """
+    # Send the keys to the focused window, using XTEST
+    CURRENTWINDOW = 0
+    # xdotool default delay between keys (ms)
+    DEFAULT_DELAY = 12
+
+    def __init__(self):
+        name = ctypes.util.find_library('xdo')
+        if name is None:
+            raise OSError('libxdo not found')
+        self.lib = ctypes.CDLL(name)
+        self.lib.xdo_new.argtypes = [ctypes.c_char_p]
+        self.lib.xdo_new.restype = ctypes.c_void_p
+        self.lib.xdo_free.argtypes = [ctypes.c_void_p]
+        self.lib.xdo_free.restype = None
+        self.lib.xdo_send_keysequence_window.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_char_p, ctypes.c_uint]
+        self.lib.xdo_send_keysequence_window.restype = ctypes.c_int
+        # Connect using DISPLAY
+        self.xdo = self.lib.xdo_new(None)
+        if not self.xdo:
+            raise OSError('libxdo failed to connect to the X server')
+
+    def key(self, command):
+        """ Same as `xdotool key [--delay MS] KEY...`.
+            Returns False if the options aren't supported """
+        delay = self.DEFAULT_DELAY
+        if len(command) > 2 and command[0] == '--delay':
+            delay = int(command[1])
+            command = command[2:]
+        if not command or command[0].startswith('--'):
+            return False
+        for key in command:
+            ret = self.lib.xdo_send_keysequence_window(self.xdo, self.CURRENTWINDOW, key.encode(), delay*1000)
+            if ret:  # pragma: no cover
+                raise CalledProcessError(ret, ['xdotool', 'key', key])
+        return True
+
+    def close(self):
+        self.lib.xdo_free(self.xdo)
+        self.xdo = None
+
+
+@contextmanager
+def xdotool_session():
+    """ Use libxdo to send the keys during the session """
+    global xdo_session
+    try:
+        xdo_session = XdotoolSession()
+    except OSError as e:  # pragma: no cover
+        logger.debug('Not using libxdo ({}), running xdotool for each key'.format(e))
+        yield
+        return
+    try:
+        yield
+    finally:
+        xdo_session.close()
+        xdo_session = None
 
 
 def xdotool(command):
+    if xdo_session is not None and command[0] == 'key' and xdo_session.key(command[1:]):
+        return b''
     return check_output(['xdotool'] + command, stderr=DEVNULL)
     # return check_output(['xdotool'] + command)
 
 
+def xdotool_script(commands):
+    """ Run a list of xdotool commands using only one xdotool process """
+    if xdo_session is not None:
+        # No process needed for the keys
+        for command in commands:
+            if command[0] == 'sleep':
+                time.sleep(float(command[1]))
+            else:
+                xdotool(command)
+        return b''
+    script = '\n'.join(' '.join(command) for command in commands)+'\n'
+    process = Popen(['xdotool', '-'], stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+    output = process.communicate(script.encode())[0]
+    if process.returncode:  # pragma: no cover
+        raise CalledProcessError(process.returncode, ['xdotool', '-'], output)
+    return output
+
+
 def clipboard_store(string):
-    # I don't know how to use Popen/run to make it run with pipes without
-    # either blocking or losing the messages.
-    # Using files works really well.
     logger.debug('Clipboard store "'+string+'"')
-    # Write the text to a file
-    fd_in, temp_in = tempfile.mkstemp(text=True)
-    os.write(fd_in, string.encode())
-    os.close(fd_in)
-    # Capture output
-    fd_out, temp_out = tempfile.mkstemp(text=True)
-    process = Popen(['xclip', '-selection', 'clipboard', temp_in], stdout=fd_out, stderr=STDOUT)
-    ret_code = process.wait()
-    os.remove(temp_in)
-    os.lseek(fd_out, 0, os.SEEK_SET)
-    ret_text = os.read(fd_out, 1000)
-    os.close(fd_out)
-    os.remove(temp_out)
+    # xclip reads the text from its stdin.
+    # Note: xclip forks a child to serve the selection, the child keeps our pipes open.
+    # So we can't read until EOF (i.e. communicate), we wait for the parent to finish
+    # and then collect the messages already in the pipe.
+    process = Popen(['xclip', '-selection', 'clipboard'], stdin=PIPE, stdout=DEVNULL, stderr=PIPE)
+    try:
+        process.stdin.write(string.encode())
+        process.stdin.close()
+    except BrokenPipeError:  # pragma: no cover
+        # xclip already finished (i.e. can't open the display), the errors are reported below
+        pass
+    try:
+        ret_code = process.wait(timeout=5)
+    except TimeoutExpired:  # pragma: no cover
+        process.kill()
+        process.wait()
+        process.stderr.close()
+        logger.error('Failed to store string in clipboard')
+        logger.error('xclip timed out')
+        raise
+    os.set_blocking(process.stderr.fileno(), False)
+    ret_text = process.stderr.read() or b''
+    process.stderr.close()
     ret_text = ret_text.decode()
     if ret_text:  # pragma: no cover
         logger.error('Failed to store string in clipboard')
@@ -217,10 +427,18 @@ def clipboard_store(string):
 
 
 def clipboard_retrieve():
-    p = Popen(['xclip', '-o', '-selection', 'clipboard'], stdout=PIPE, stderr=STDOUT)
-    output = ''
-    for line in p.stdout:
-        output += line.decode()
+    # Here xclip doesn't fork, so we can read both pipes until EOF.
+    # Errors (i.e. empty clipboard) are just logged, they aren't part of the clipboard.
+    p = Popen(['xclip', '-o', '-selection', 'clipboard'], stdout=PIPE, stderr=PIPE)
+    try:
+        output, error = p.communicate(timeout=5)
+    except TimeoutExpired:  # pragma: no cover
+        p.kill()
+        output, error = p.communicate()
+        logger.error('Timed out reading the clipboard')
+    if error:
+        logger.debug('xclip: '+error.decode().rstrip())
+    output = output.decode()
     logger.debug('Clipboard retrieve "'+output+'"')
     return output
 
@@ -228,7 +446,7 @@ def clipboard_retrieve():
 def debug_window(id=None):  # pragma: no cover
     if log.get_level() < 2:
         return
-    if shutil.which('xprop'):
+    if _XPROP is not None:
         if id is None:
             try:
                 id = xdotool(['getwindowfocus']).rstrip()
@@ -236,18 +454,47 @@ def debug_window(id=None):  # pragma: no cover
                 logger.debug('xdotool getwindowfocus failed!')
                 pass
         if id:
-            call(['xprop', '-id', id])
+            call([_XPROP, '-id', id])
+
+
+def get_focused_id():
+    """ Id of the window with the focus, as reported by `xdotool getwindowfocus`.
+        None if no window has the focus """
+    if x_display is None:  # pragma: no cover
+        try:
+            return xdotool(['getwindowfocus']).rstrip()
+        except CalledProcessError:
+            # When no window is available xdotool receives ID=1 and exits with error
+            return None
+    focus = x_display.get_input_focus().focus
+    if isinstance(focus, int):
+        # None or PointerRoot
+        return None
+    # Like xdotool: look for the client window (the one with WM_STATE) in the parents.
+    # If none (i.e. no WM) use the focused window.
+    wm_state = x_display.intern_atom('WM_STATE')
+    window = focus
+    try:
+        while window:
+            if window.get_full_property(wm_state, X.AnyPropertyType) is not None:
+                return str(window.id).encode()
+            window = window.query_tree().parent
+    except XError:  # pragma: no cover
+        # The window was destroyed
+        return None
+    return str(focus.id).encode()
 
 
 def wait_focused(id, timeout=10):
     DELAY = 0.5
     logger.debug('Waiting for %s window to get focus...', id)
-    for i in range(int(timeout/DELAY)):
-        cur_id = xdotool(['getwindowfocus']).rstrip()
+    if has_xlib:
+        _select_x_events(id, X.FocusChangeMask | X.StructureNotifyMask)
+    for _ in _timed_loop(timeout, DELAY):
+        cur_id = get_focused_id()
         logger.debug('Currently focused id: %s', cur_id)
         if cur_id == id:
             return
-        time.sleep(DELAY)
     debug_window(cur_id)  # pragma: no cover
     raise RuntimeError('Timed out waiting for %s window to get focus' % id)
 
@@ -255,20 +502,81 @@ def wait_focused(id, timeout=10):
 def wait_not_focused(id, timeout=10):
     DELAY = 0.5
     logger.debug('Waiting for %s window to lose focus...', id)
-    for i in range(int(timeout/DELAY)):
-        try:
-            cur_id = xdotool(['getwindowfocus']).rstrip()
-        except CalledProcessError:
-            # When no window is available xdotool receives ID=1 and exits with error
+    if has_xlib:
+        _select_x_events(id, X.FocusChangeMask | X.StructureNotifyMask)
+    for _ in _timed_loop(timeout, DELAY):
+        cur_id = get_focused_id()
+        if cur_id is None:
             return
         logger.debug('Currently focused id: %s', cur_id)
         if cur_id != id:
             return
-        time.sleep(DELAY)
     debug_window(cur_id)  # pragma: no cover
     raise RuntimeError('Timed out waiting for %s window to lose focus' % id)
 
 
+def get_window_name(id):
+    """ Name of the id window, as reported by `xdotool getwindowname`.
+        Empty if the window is gone """
+    if x_display is None:  # pragma: no cover
+        try:
+            return xdotool(['getwindowname', id]).decode().rstrip()
+        except CalledProcessError:
+            return ''
+    window = x_display.create_resource_object('window', int(id))
+    try:
+        name = window.get_full_property(x_display.intern_atom('_NET_WM_NAME'), X.AnyPropertyType)
+        name = name.value if name else window.get_wm_name()
+    except XError:  # pragma: no cover
+        return ''
+    if isinstance(name, bytes):
+        name = name.decode(errors='replace')
+    return name or ''
+
+
+def find_any_window(others):
+    """ Look for a visible window matching any of the `others` regexs.
+        Returns the regex that matched, the first in the list when more than one matches.
+        All the regexs are searched using one xdotool call """
+    cmd = ['search', '--onlyvisible', '--name', '|'.join('('+other+')' for other in others)]
+    try:
+        window_ids = xdotool(cmd).splitlines()
+    except CalledProcessError:
+        return None
+    if len(others) == 1:
+        return others[0]
+    # Find which one matched, xdotool regexs are case insensitive
+    names = [get_window_name(id) for id in window_ids]
+    for other in others:
+        for name in names:
+            if re.search(other, name, re.IGNORECASE):
+                return other
+    # Shouldn't happen, but the regex dialects differ, ask xdotool for each one
+    for other in others:  # pragma: no cover
+        try:
+            xdotool(['search', '--onlyvisible', '--name', other])
+            return other
+        except CalledProcessError:
+            pass
+    return None  # pragma: no cover
+
+
+def wait_for_any(name, regexs, timeout=10):
+    """ Wait for a visible window matching any of the regexs.
+        Returns the regex that matched, the first in the list has priority.
+        On each retry all the regexs are searched using one xdotool call """
+    DELAY = 0.5
+    # Callers usually focus the window using wait_for_window, which informs the wait
+    logger.debug('Looking for %s windows ...', name)
+    for _ in _timed_loop(timeout, DELAY):
+        found = find_any_window(regexs)
+        if found:
+            logger.debug('Found "%s" window', found)
+            return found
+    debug_window()  # pragma: no cover
+    raise RuntimeError('Timed out waiting for %s' % name)
+
+
 def wait_for_window(name, window_regex, timeout=10, focus=True, skip_id=0, others=None):
     DELAY = 0.5
     logger.info('Waiting for "%s" ...', name)
@@ -276,7 +584,7 @@ def wait_for_window(name, window_regex, timeout=10, focus=True, skip_id=0, other
         logger.debug('Will skip %s', skip_id)
     xdotool_command = ['search', '--onlyvisible', '--name', window_regex]
 
-    for i in range(int(timeout/DELAY)):
+    for _ in _timed_loop(timeout, DELAY):
         try:
             window_id = xdotool(xdotool_command).splitlines()
             logger.debug('Found %s window (%d)', name, len(window_id))
@@ -287,9 +595,10 @@ def wait_for_window(name, window_regex, timeout=10, focus=True, skip_id=0, other
             logger.debug('Window id: %s', id)
             if id != skip_id:
                 if focus:
-                    xdotool_command = ['windowfocus', '--sync', id]
-                    xdotool(xdotool_command)
-                    wait_focused(id, timeout)
+                    # Focus it and get who has the focus using one xdotool run
+                    cur_id = xdotool(['windowfocus', '--sync', id, 'getwindowfocus']).rstrip()
+                    if cur_id != id:
+                        wait_focused(id, timeout)
                 return window_id
             else:
                 logger.debug('Skipped')
@@ -297,14 +606,9 @@ def wait_for_window(name, window_regex, timeout=10, focus=True, skip_id=0, other
             pass
         # Check if we have a list of alternative windows
         if others:
-            for other in others:
-                cmd = ['search', '--onlyvisible', '--name', other]
-                try:
-                    xdotool(cmd)
-                    raise ValueError(other)
-                except CalledProcessError:
-                    pass
-        time.sleep(DELAY)
+            other = find_any_window(others)
+            if other:
+                raise ValueError(other)
     debug_window()  # pragma: no cover
     raise RuntimeError('Timed out waiting for %s window' % name)
 
@@ -51,6 +51,49 @@ def test_pcbnew_config_backup():
     ctx.clean_up()
 
 
+def test_pcbnew_config_restore():
+    """ The user config must be restored after using ours """
+    ctx = context.TestContext('PCBnew_config_restore', 'good-project')
+    os.makedirs(ctx.kicad_cfg_dir, exist_ok=True)
+    old_config = None
+    if os.path.isfile(ctx.pcbnew_conf):
+        with open(ctx.pcbnew_conf, 'rt') as f:
+            old_config = f.read()
+    else:
+        with open(ctx.pcbnew_conf, 'wt') as f:
+            f.write('Dummy config\n')
+    try:
+        cmd = [PROG, 'export', '--output_name', 'restore.pdf']
+        ctx.run(cmd, extra=['F.Cu'])
+        assert not os.path.islink(ctx.pcbnew_conf)
+        assert not os.path.isfile(ctx.pcbnew_conf + '.pre_script')
+        with open(ctx.pcbnew_conf, 'rt') as f:
+            assert f.read() == (old_config if old_config is not None else 'Dummy config\n')
+    finally:
+        if old_config is None:
+            os.remove(ctx.pcbnew_conf)
+    ctx.clean_up()
+
+
+def test_pcbnew_config_no_user():
+    """ Without a user config we must not leave a dangling link to our config """
+    ctx = context.TestContext('PCBnew_config_no_user', 'good-project')
+    old_config = None
+    if os.path.isfile(ctx.pcbnew_conf):
+        with open(ctx.pcbnew_conf, 'rt') as f:
+            old_config = f.read()
+        os.remove(ctx.pcbnew_conf)
+    try:
+        cmd = [PROG, 'export', '--output_name', 'no_user.pdf']
+        ctx.run(cmd, extra=['F.Cu'])
+        assert not os.path.islink(ctx.pcbnew_conf)
+    finally:
+        if old_config is not None:
+            with open(ctx.pcbnew_conf, 'wt') as f:
+                f.write(old_config)
+    ctx.clean_up()
+
+
 def test_pcb_not_found():
     """ When the provided .kicad_pcb isn't there """
     prj = 'good-project'
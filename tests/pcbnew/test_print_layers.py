@@ -44,6 +44,20 @@ def test_print_pcb_good_dwg_1():
     ctx.clean_up()
 
 
+def test_print_pcb_good_dwg_sparse():
+    """ Only the used layers in the KiCad 5 config, the PDF must be the same """
+    ctx = context.TestContext('Print_Good_with_Dwg_Sparse', 'good-project')
+    pdf = 'good_pcb_with_dwg.pdf'
+    cmd = [PROG, 'export', '--sparse-layer-block', '--output_name', pdf]
+    layers = ['F.Cu', 'F.SilkS', 'Dwgs.User', 'Edge.Cuts']
+    ctx.run(cmd, extra=layers)
+    ctx.expect_out_file(pdf)
+    ctx.compare_image(pdf)
+    if ctx.kicad_version >= context.KICAD_VERSION_5_99:
+        assert ctx.search_err(r"--sparse-layer-block only applies to KiCad 5")
+    ctx.clean_up()
+
+
 def test_print_pcb_good_inner():
     ctx = context.TestContext('Print_Good_Inner', 'good-project')
     cmd = [PROG, 'export']